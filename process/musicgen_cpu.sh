@@ -40,6 +40,7 @@ Environment overrides passed through to MusicGen:
   MUSICGEN_OUTPUT         Defaults to <track_id>_modern_instrumental.wav (under outputs/musicgen)
   MUSICGEN_PROMPT         Defaults to script-defined modern pop prompt
   MUSICGEN_DURATION       Defaults to 30.0
+  MUSICGEN_MODEL          Defaults to facebook/musicgen-melody (musicgen-small on GPUs < 10 GiB)
 
 Examples:
   process/musicgen_cpu.sh poor_man_rose
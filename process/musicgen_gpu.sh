@@ -37,7 +37,9 @@ Environment overrides passed through to MusicGen:
   MUSICGEN_OUTPUT         Defaults to <track_id>_modern_instrumental.wav (under outputs/<track_id>/musicgen)
   MUSICGEN_PROMPT         Defaults to script-defined modern pop prompt
   MUSICGEN_DURATION       Defaults to 30.0
+  MUSICGEN_MODEL          Defaults to facebook/musicgen-melody (musicgen-small on GPUs < 10 GiB)
   MUSICGEN_DEVICE         Defaults to cuda
+  MUSICGEN_COMPILE        Set to 1 to torch.compile the MusicGen decoder (experimental)
 
 Examples:
   process/musicgen_gpu.sh poor_man_rose
@@ -20,7 +20,7 @@ Examples:
 
 Environment variables:
   PYTHON_BIN  Override the Python 3.10 executable used to manage the venv (default: python3.10)
-  DEMUCS_DEVICE  Demucs device override (default: cpu; set to cuda to try GPU)
+  DEMUCS_DEVICE  Demucs and stem resampling device (default: cpu; set to cuda to try GPU)
 EOF
 	exit 1
 }
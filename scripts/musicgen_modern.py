@@ -9,10 +9,22 @@ Requirements:
 - Run inside a Python 3.10 virtual environment with audiocraft installed, e.g.:
     python -m pip install --no-cache-dir git+https://github.com/facebookresearch/audiocraft@v1.2.0
 - Ensure the reference file exists (default: melody_reference.wav within the outputs/<track> folder).
+
+Set MUSICGEN_BATCH to a JSON file holding a list of
+{"prompt": ..., "reference": ..., "output": ...} entries to render several
+tracks with one model load; jobs are generated together in batches of up to
+MUSICGEN_MAX_BATCH (default 4).
+
+Set MUSICGEN_MODEL to pick a checkpoint (e.g. facebook/musicgen-small for fast
+iteration). When unset, GPUs with less than 10 GiB of VRAM use musicgen-small;
+everything else uses musicgen-melody.
 """
 
+import hashlib
+import json
 import os
 from pathlib import Path
+from typing import Dict, List, Optional
 
 os.environ.setdefault("TORCHAUDIO_USE_TORCHCODEC", "0")
 
@@ -22,6 +34,10 @@ import torchaudio
 from audiocraft.data.audio import audio_write
 from audiocraft.models import MusicGen
 
+# The reference length and generation duration are fixed per run, so cuDNN can
+# profile the EnCodec conv shapes once and reuse the fastest kernels.
+torch.backends.cudnn.benchmark = True
+
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 
@@ -43,6 +59,13 @@ else:
 	OUTPUT_DIR = PROJECT_ROOT / "outputs" / "musicgen"
 
 OUTPUT_PATH = OUTPUT_DIR / OUTPUT_FILENAME
+CACHE_DIR = OUTPUT_DIR / ".cache"
+
+MODEL_NAME = os.environ.get("MUSICGEN_MODEL")
+MELODY_MODEL = "facebook/musicgen-melody"
+SMALL_MODEL = "facebook/musicgen-small"
+# GPUs below this much VRAM default to the small model when MUSICGEN_MODEL is unset.
+SMALL_MODEL_VRAM_BYTES = 10 * 2**30
 
 # Adjust the prompt to taste; add stylistic cues you want MusicGen to follow.
 PROMPT = os.environ.get(
@@ -55,6 +78,13 @@ PROMPT = os.environ.get(
 TARGET_DURATION_ENV = os.environ.get("MUSICGEN_DURATION")
 TARGET_DURATION = float(TARGET_DURATION_ENV) if TARGET_DURATION_ENV is not None else None
 DEVICE_PREF = os.environ.get("MUSICGEN_DEVICE", "auto").lower()
+# torch.compile of the decoder is opt-in until it has been benchmarked.
+COMPILE_LM = os.environ.get("MUSICGEN_COMPILE", "0") == "1"
+
+# Optional JSON list of {"prompt", "reference", "output"} jobs rendered in
+# batched generate calls of at most MUSICGEN_MAX_BATCH items.
+BATCH_FILE_ENV = os.environ.get("MUSICGEN_BATCH")
+MAX_BATCH = max(1, int(os.environ.get("MUSICGEN_MAX_BATCH", "4")))
 
 
 def resolve_device() -> str:
@@ -86,14 +116,19 @@ def resolve_device() -> str:
 	return _try_cuda(explicit=False)
 
 
-def load_reference(device: str, sample_rate: int) -> torch.Tensor:
-	if not REFERENCE_PATH.exists():
+def load_reference(
+	path: Path,
+	device: str,
+	sample_rate: int,
+	stream: Optional["torch.cuda.Stream"] = None,
+) -> torch.Tensor:
+	if not path.exists():
 		raise FileNotFoundError(
-			f"Reference audio missing: {REFERENCE_PATH}\n"
+			f"Reference audio missing: {path}\n"
 			"Generate it first (e.g., mix drums/bass/other stems into melody_reference.wav)."
 		)
 
-	data, sr = sf.read(REFERENCE_PATH)
+	data, sr = sf.read(path)
 	if data.ndim == 1:
 		data = data[:, None]
 	melody = torch.from_numpy(data.T).float()
@@ -101,17 +136,147 @@ def load_reference(device: str, sample_rate: int) -> torch.Tensor:
 		melody = torchaudio.functional.resample(melody, sr, sample_rate)
 
 	# MusicGen expects shape (batch, channels, time)
-	return melody.unsqueeze(0).to(device)
+	if device != "cuda":
+		return melody.unsqueeze(0).to(device)
 
+	# Cast on the host, then copy from pinned memory asynchronously (on `stream`
+	# when given) so the transfer overlaps with host-side setup.
+	melody = melody.unsqueeze(0).to(torch.float16).pin_memory()
+	with torch.cuda.stream(stream or torch.cuda.current_stream()):
+		return melody.to(device, non_blocking=True)
 
-def main() -> None:
-	device = resolve_device()
-	print(f"[musicgen] Using device: {device}")
-	model = MusicGen.get_pretrained("facebook/musicgen-melody", device=device)
-	melody = load_reference(device, model.sample_rate)
+
+def load_jobs() -> List[Dict]:
+	"""
+	Return the render jobs: the single env-configured job, or every entry of the
+	MUSICGEN_BATCH file. Relative references resolve against the batch file's
+	directory and relative outputs against OUTPUT_DIR.
+	"""
+	if not BATCH_FILE_ENV:
+		return [{"prompt": PROMPT, "reference": REFERENCE_PATH, "output": OUTPUT_PATH}]
+
+	batch_file = Path(BATCH_FILE_ENV)
+	if not batch_file.is_absolute():
+		batch_file = PROJECT_ROOT / batch_file
+	jobs = []
+	for entry in json.loads(batch_file.read_text()):
+		reference = Path(entry["reference"])
+		if not reference.is_absolute():
+			reference = batch_file.parent / reference
+		output = Path(entry["output"])
+		if not output.is_absolute():
+			output = OUTPUT_DIR / output
+		jobs.append({"prompt": entry.get("prompt", PROMPT), "reference": reference, "output": output})
+	return jobs
+
+
+def resolve_model_name(device: str) -> str:
+	if MODEL_NAME:
+		return MODEL_NAME
+	if device == "cuda" and torch.cuda.get_device_properties(0).total_memory < SMALL_MODEL_VRAM_BYTES:
+		print(f"[musicgen] Less than 10 GiB of VRAM; defaulting to {SMALL_MODEL}.")
+		return SMALL_MODEL
+	return MELODY_MODEL
+
+
+def supports_chroma(model: MusicGen) -> bool:
+	return "self_wav" in model.lm.condition_provider.conditioners
+
+
+def cache_chroma_embeddings(model: MusicGen, model_name: str) -> None:
+	"""
+	Memoize the chroma conditioner on disk, keyed by a hash of the melody
+	waveform, so re-runs with the same reference skip chroma extraction.
+	"""
+	conditioners = model.lm.condition_provider.conditioners
+	# conditioners is an nn.ModuleDict, which has no .get()
+	conditioner = conditioners["self_wav"] if "self_wav" in conditioners else None
+	compute = getattr(conditioner, "_get_wav_embedding", None)
+	if compute is None or getattr(conditioner, "_disk_cached", False):
+		return
+
+	def cached(x):
+		wav = x.wav.detach().cpu().contiguous()
+		digest = hashlib.sha1(wav.numpy().tobytes())
+		digest.update(f"{model_name}:{wav.dtype}:{tuple(wav.shape)}".encode())
+		cache_path = CACHE_DIR / f"chroma_{digest.hexdigest()[:16]}.pt"
+		if cache_path.exists():
+			return torch.load(cache_path, map_location=x.wav.device)
+		embeds = compute(x)
+		cache_path.parent.mkdir(parents=True, exist_ok=True)
+		torch.save(embeds.detach().cpu(), cache_path)
+		return embeds
+
+	conditioner._get_wav_embedding = cached
+	conditioner._disk_cached = True
+
+
+def enable_efficient_attention(model: MusicGen) -> None:
+	"""
+	Make sure the LM's attention goes through PyTorch's fused
+	scaled_dot_product_attention (flash / memory-efficient kernels). Stock
+	MusicGen checkpoints already take this path (memory_efficient: true, torch
+	backend, SDPA kernels on by default); this only pins it for custom configs.
+	The math backend stays enabled so unsupported GPUs still have a fallback.
+	"""
+	torch.backends.cuda.enable_flash_sdp(True)
+	torch.backends.cuda.enable_mem_efficient_sdp(True)
+	try:
+		from audiocraft.modules.transformer import StreamingMultiheadAttention, set_efficient_attention_backend
+	except ImportError:
+		return
+
+	set_efficient_attention_backend("torch")
+	for module in model.lm.modules():
+		# Only custom-attention layers can switch paths: non-custom ones wrap an
+		# nn.MultiheadAttention and their KV-cache layout depends on the flag.
+		if isinstance(module, StreamingMultiheadAttention) and module.custom:
+			module.memory_efficient = True
+
+
+def compile_transformer(model: MusicGen) -> None:
+	"""
+	Compile the LM transformer's forward with Inductor to fuse attention/MLP
+	kernels. The transformer is patched rather than wrapping `model.lm` because
+	LMModel.generate calls the underlying module directly. CUDA graphs are not
+	used and shapes are marked dynamic since the streaming KV cache grows by one
+	step per token. Compile errors during generation are not retried in eager
+	mode: a failed step may already have appended to the layers' KV caches, so
+	the run fails instead (unset MUSICGEN_COMPILE to run eager).
+	"""
+	transformer = model.lm.transformer
+	try:
+		transformer.forward = torch.compile(transformer.forward, mode="default", dynamic=True)
+	except Exception as err:
+		print(f"[musicgen] torch.compile unavailable; running eager. ({err})")
+
+
+def load_model(model_name: str, device: str) -> MusicGen:
+	model = MusicGen.get_pretrained(model_name, device=device)
+	if device == "cuda":
+		# audiocraft already loads the LM in float16 on GPU; cast the EnCodec
+		# compression model to match. torch.autocast is avoided on purpose:
+		# per-op casts can end up slower than pure FP16 weights.
+		model.compression_model.to(torch.float16)
+		enable_efficient_attention(model)
+		if COMPILE_LM:
+			compile_transformer(model)
+	if any(isinstance(m, torch.nn.Conv2d) for m in model.compression_model.modules()):
+		# channels_last only affects 4D weights; stock EnCodec is all Conv1d, in
+		# which case the default contiguous layout is already what cuDNN wants.
+		model.compression_model = model.compression_model.to(memory_format=torch.channels_last)
+	cache_chroma_embeddings(model, model_name)
+	return model
+
+
+def render_batch(model: MusicGen, model_name: str, jobs: List[Dict], device: str) -> None:
+	copy_stream = torch.cuda.Stream() if device == "cuda" else None
+	melodies = [load_reference(job["reference"], device, model.sample_rate, copy_stream) for job in jobs]
+	# References are resampled to model.sample_rate, so lengths are in output samples
+	lengths = [m.shape[-1] for m in melodies]
 	target_duration = TARGET_DURATION
 	if target_duration is None:
-		target_duration = melody.shape[-1] / model.sample_rate
+		target_duration = max(lengths) / model.sample_rate
 
 	model.set_generation_params(
 		duration=target_duration,
@@ -121,29 +286,61 @@ def main() -> None:
 		cfg_coef=4.0,
 	)
 
-	wav = model.generate_with_chroma(
-		descriptions=[PROMPT],
-		melody_wavs=[melody.squeeze(0)],
-		melody_sample_rate=model.sample_rate,
-	)[0].cpu()
-
-	if wav.dim() == 1:
-		wav = wav.unsqueeze(0)
-	if wav.shape[0] == 1:
-		wav = wav.repeat(2, 1)
-
-	OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-	audio_write(
-		OUTPUT_PATH,
-		wav,
-		model.sample_rate,
-		strategy="loudness",
-		add_suffix=False,
-	)
+	if copy_stream is not None:
+		torch.cuda.current_stream().wait_stream(copy_stream)
+		for melody in melodies:
+			melody.record_stream(torch.cuda.current_stream())
 
-	print(f"[musicgen] Saved modern instrumental to {OUTPUT_PATH}")
+	descriptions = [job["prompt"] for job in jobs]
+	if supports_chroma(model):
+		wavs = model.generate_with_chroma(
+			descriptions=descriptions,
+			melody_wavs=[m.squeeze(0) for m in melodies],
+			melody_sample_rate=model.sample_rate,
+		)
+	else:
+		print(f"[musicgen] {model_name} has no melody conditioning; generating from the prompt only.")
+		wavs = model.generate(descriptions=descriptions)
+
+	for job, wav, length in zip(jobs, wavs, lengths):
+		wav = wav.float().cpu()
+		if TARGET_DURATION is None:
+			# The batch renders at the longest reference's duration; cut each
+			# output back to its own reference length.
+			wav = wav[..., :length]
+		if wav.dim() == 1:
+			wav = wav.unsqueeze(0)
+		if wav.shape[0] == 1:
+			wav = wav.repeat(2, 1)
+
+		job["output"].parent.mkdir(parents=True, exist_ok=True)
+		audio_write(
+			job["output"],
+			wav,
+			model.sample_rate,
+			strategy="loudness",
+			add_suffix=False,
+		)
+		print(f"[musicgen] Saved modern instrumental to {job['output']}")
+
+
+def main() -> None:
+	device = resolve_device()
+	print(f"[musicgen] Using device: {device}")
+	# Let any remaining FP32 matmuls/convs run on TF32 tensor cores (Ampere+).
+	torch.backends.cuda.matmul.allow_tf32 = True
+	torch.backends.cudnn.allow_tf32 = True
+	torch.set_float32_matmul_precision("high")
+	model_name = resolve_model_name(device)
+	print(f"[musicgen] Using model: {model_name}")
+	model = load_model(model_name, device)
+
+	jobs = load_jobs()
+	if len(jobs) > MAX_BATCH:
+		print(f"[musicgen] {len(jobs)} jobs exceed MUSICGEN_MAX_BATCH={MAX_BATCH}; rendering in chunks.")
+	for start in range(0, len(jobs), MAX_BATCH):
+		render_batch(model, model_name, jobs[start:start + MAX_BATCH], device)
 
 
 if __name__ == "__main__":
 	main()
-
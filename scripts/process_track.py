@@ -1,10 +1,19 @@
 import os
 import sys
+import json
 import math
+import hashlib
+import tempfile
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
+
+# Demucs runs in this process, so force these before torchaudio is imported:
+# avoid the TorchCodec DLL path on Windows and rely on the soundfile backend
+os.environ["TORCHAUDIO_USE_TORCHCODEC"] = "0"
+os.environ["TORCHAUDIO_AUDIO_BACKEND"] = "soundfile"
 
 import click
 from rich import print as rprint
@@ -12,12 +21,18 @@ from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, TextColumn
 
 import numpy as np
-from pydub import AudioSegment
+import torch
+import torch.nn.functional as F
+import torchaudio
+import soundfile as sf
 import ffmpeg
 
 
 console = Console()
 
+STEM_NAMES = ("vocals", "drums", "bass", "other")
+LOUDNORM_MEASURED_KEYS = ("input_i", "input_lra", "input_tp", "input_thresh", "target_offset")
+
 
 def ensure_dir(path: Path) -> None:
 	"""Create a directory if it does not exist."""
@@ -36,6 +51,15 @@ def db_to_ratio(db: float) -> float:
 	return 10 ** (db / 20.0)
 
 
+def _hash_file(path: Path, chunk: int = 1 << 20) -> str:
+	"""SHA-1 of a file, streamed in fixed-size blocks to keep memory flat."""
+	h = hashlib.sha1()
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(chunk), b""):
+			h.update(block)
+	return h.hexdigest()
+
+
 def run_demucs(input_path: Path, separated_root: Path) -> Path:
 	"""
 	Run Demucs to separate stems. Returns the path to the final stems directory
@@ -50,15 +74,21 @@ def run_demucs(input_path: Path, separated_root: Path) -> Path:
 		else:
 			existing.unlink()
 	model = "htdemucs"
+
+	# Reuse stems from a previous run on byte-identical input
+	cache_dir = separated_root.parent / "stems_cache" / _hash_file(input_path)[:16]
+	cached_stems = [cache_dir / f"{name}.wav" for name in STEM_NAMES]
+	if all(p.exists() for p in cached_stems):
+		rprint(f"[cyan]Reusing cached Demucs stems from {cache_dir}[/cyan]")
+		for stem in cached_stems:
+			shutil.copy2(stem, separated_root / stem.name)
+		return separated_root
+
 	device = os.environ.get("DEMUCS_DEVICE", "cuda").strip()
-	cmd = [
-		sys.executable,
-		"-m",
-		"demucs",
-	]
+	args = []
 	if device:
-		cmd.extend(["--device", device])
-	cmd.extend([
+		args.extend(["--device", device])
+	args.extend([
 		"-n",
 		model,
 		"-o",
@@ -68,19 +98,27 @@ def run_demucs(input_path: Path, separated_root: Path) -> Path:
 	rprint(f"[cyan]Running Demucs separation with model '{model}'...[/cyan]")
 	if device:
 		rprint(f"[cyan]Using Demucs device: {device}[/cyan]")
-	# Prepare environment to avoid TorchCodec path on Windows and prefer local ffmpeg7 if present
-	env = os.environ.copy()
-	# Force torchaudio to avoid TorchCodec DLL usage and rely on soundfile backend
-	env["TORCHAUDIO_USE_TORCHCODEC"] = "0"
-	env["TORCHAUDIO_AUDIO_BACKEND"] = "soundfile"
-	# Prepend tools\ffmpeg7\bin if available (relative to current working directory)
+	# Prepend tools\ffmpeg7\bin for the Demucs call only (relative to current
+	# working directory), so mastering uses the same ffmpeg on cache hits and misses
+	original_path = os.environ.get("PATH", "")
 	try:
 		ff7_bin = Path("./tools/ffmpeg7/bin")
 		if ff7_bin.exists():
-			env["PATH"] = str(ff7_bin.resolve()) + os.pathsep + env.get("PATH", "")
+			os.environ["PATH"] = str(ff7_bin.resolve()) + os.pathsep + original_path
 	except Exception:
 		pass
-	subprocess.run(cmd, check=True, env=env)
+
+	# Import lazily so cached runs never pay for loading Demucs
+	from demucs.separate import main as demucs_main
+
+	try:
+		demucs_main(args)
+	except SystemExit as exc:
+		# The Demucs CLI entry point reports failures via sys.exit
+		if exc.code:
+			raise RuntimeError(f"Demucs separation failed (exit code {exc.code}).") from exc
+	finally:
+		os.environ["PATH"] = original_path
 
 	# Demucs output is: separated_root / model / track_basename
 	model_dir = separated_root / model
@@ -106,89 +144,229 @@ def run_demucs(input_path: Path, separated_root: Path) -> Path:
 	# Remove intermediate directories created by Demucs
 	shutil.rmtree(model_dir, ignore_errors=True)
 
+	# Populate the cache in a temp sibling and rename it into place, so an
+	# interrupted copy never leaves truncated stems that look like a hit
+	stems = [separated_root / f"{name}.wav" for name in STEM_NAMES]
+	if all(p.exists() for p in stems):
+		ensure_dir(cache_dir.parent)
+		staging = Path(tempfile.mkdtemp(prefix=f".{cache_dir.name}-", dir=cache_dir.parent))
+		try:
+			for stem in stems:
+				shutil.copy2(stem, staging / stem.name)
+			shutil.rmtree(cache_dir, ignore_errors=True)
+			os.replace(staging, cache_dir)
+		finally:
+			shutil.rmtree(staging, ignore_errors=True)
+
 	return separated_root
 
 
-def load_audio_segment(path: Path, target_sr: int) -> AudioSegment:
-	seg = AudioSegment.from_file(str(path))
-	if seg.frame_rate != target_sr:
-		seg = seg.set_frame_rate(target_sr)
-	return seg
+def resolve_resample_device() -> str:
+	"""
+	Follow the DEMUCS_DEVICE choice for resampling, but only use CUDA after a
+	trial op succeeds: torch can report CUDA as available on GPUs it has no
+	kernels for (e.g. sm_120 with the pinned torch build).
+	"""
+	device = os.environ.get("DEMUCS_DEVICE", "cuda").strip()
+	if not device.startswith("cuda"):
+		return "cpu"
+	try:
+		if not torch.cuda.is_available():
+			raise RuntimeError("CUDA not available")
+		torch.zeros(1, device=device)
+		return device
+	except Exception as err:
+		rprint(f"[yellow]CUDA not usable for resampling; falling back to CPU. ({err})[/yellow]")
+		return "cpu"
 
 
-def trim_or_pad(seg: AudioSegment, target_ms: int) -> AudioSegment:
-	if len(seg) == target_ms:
-		return seg
-	if len(seg) > target_ms:
-		return seg[:target_ms]
-	pad_ms = target_ms - len(seg)
-	return seg + AudioSegment.silent(duration=pad_ms, frame_rate=seg.frame_rate)
+def decode_audio(path: Path) -> Tuple[torch.Tensor, int]:
+	"""Decode an audio file into a float32 (2, N) tensor at its native rate."""
+	wav, sr = torchaudio.load(str(path))
+	if wav.shape[0] == 1:
+		wav = wav.repeat(2, 1)
+	return wav[:2], sr
+
+
+def load_audio_batch(paths: Dict[str, Path], target_sr: int, device: str) -> Dict[str, np.ndarray]:
+	"""
+	Decode audio files into float32 (2, N) arrays at target_sr. Files are
+	decoded concurrently (libsndfile/ffmpeg release the GIL), then those sharing
+	a source rate are padded, stacked and resampled on `device` in one call so
+	the resampling kernel is only built once per rate.
+	"""
+	with ThreadPoolExecutor(max_workers=max(1, min(len(paths), 4))) as executor:
+		futures = {name: executor.submit(decode_audio, path) for name, path in paths.items()}
+		decoded = {name: future.result() for name, future in futures.items()}
+
+	by_rate: Dict[int, list] = {}
+	for name, (_, sr) in decoded.items():
+		by_rate.setdefault(sr, []).append(name)
+
+	result: Dict[str, np.ndarray] = {}
+	for sr, names in by_rate.items():
+		if sr == target_sr:
+			for name in names:
+				result[name] = decoded[name][0].numpy()
+			continue
+		lengths = [decoded[name][0].shape[-1] for name in names]
+		max_len = max(lengths)
+		batch = torch.stack([F.pad(decoded[name][0], (0, max_len - n)) for name, n in zip(names, lengths)])
+		resampled = torchaudio.functional.resample(batch.to(device), sr, target_sr).cpu()
+		for i, (name, n) in enumerate(zip(names, lengths)):
+			result[name] = resampled[i, :, :math.ceil(n * target_sr / sr)].numpy()
+
+	return {name: audio.astype(np.float32, copy=False) for name, audio in result.items()}
 
 
 def mix_stems(
-	vocals: Optional[AudioSegment],
-	drums: Optional[AudioSegment],
-	bass: Optional[AudioSegment],
-	other: Optional[AudioSegment],
-	replace_vocals: Optional[AudioSegment],
-	replace_instrumental: Optional[AudioSegment],
+	vocals: Optional[np.ndarray],
+	drums: Optional[np.ndarray],
+	bass: Optional[np.ndarray],
+	other: Optional[np.ndarray],
+	replace_vocals: Optional[np.ndarray],
+	replace_instrumental: Optional[np.ndarray],
 	gains_db: Tuple[float, float, float, float],
-) -> AudioSegment:
+) -> np.ndarray:
 	"""
-	Mix stems using simple gain and overlay logic.
+	Mix float32 (2, N) stems with per-stem gain, accumulating in place into a
+	single preallocated buffer. Shorter stems are implicitly zero-padded.
+	The result is a (2, N) view over frame-interleaved (N, 2) storage, so
+	`mix.T` is already in the layout ffmpeg and soundfile expect.
 	gains_db order: (vocals, drums, bass, other)
 	"""
-	target_len = 0
-	segments = [s for s in [vocals, drums, bass, other, replace_vocals, replace_instrumental] if s is not None]
-	if not segments:
+	stems = [s for s in [vocals, drums, bass, other, replace_vocals, replace_instrumental] if s is not None]
+	if not stems:
 		raise ValueError("No audio segments to mix.")
-	target_len = max(len(s) for s in segments)
+	target_len = max(s.shape[-1] for s in stems)
+	out = np.zeros((target_len, 2), dtype=np.float32).T
 
-	def safe(seg: Optional[AudioSegment]) -> AudioSegment:
-		return trim_or_pad(seg, target_len) if seg is not None else AudioSegment.silent(duration=target_len)
+	def accumulate(audio: Optional[np.ndarray], gain: np.float32) -> None:
+		if audio is None:
+			return
+		head = out[:, :audio.shape[-1]]
+		np.add(head, audio * gain, out=head)
 
-	vocals_gain_db, drums_gain_db, bass_gain_db, other_gain_db = gains_db
+	# float32 scalars keep every product and the accumulator in float32
+	vocals_gain, drums_gain, bass_gain, other_gain = (np.float32(db_to_ratio(db)) for db in gains_db)
 
 	if replace_instrumental is not None:
-		instrumental = safe(replace_instrumental)
+		accumulate(replace_instrumental, np.float32(1.0))
 	else:
-		instrumental = AudioSegment.silent(duration=target_len)
-		instrumental = instrumental.overlay(safe(drums) + drums_gain_db)
-		instrumental = instrumental.overlay(safe(bass) + bass_gain_db)
-		instrumental = instrumental.overlay(safe(other) + other_gain_db)
+		accumulate(drums, drums_gain)
+		accumulate(bass, bass_gain)
+		accumulate(other, other_gain)
 
-	if replace_vocals is not None:
-		v = safe(replace_vocals) + vocals_gain_db
-	else:
-		v = safe(vocals) + vocals_gain_db if vocals is not None else AudioSegment.silent(duration=target_len)
+	accumulate(replace_vocals if replace_vocals is not None else vocals, vocals_gain)
+	return out
 
-	mix = instrumental.overlay(v)
-	return mix
 
+def _measure_loudnorm(
+	pcm: memoryview,
+	sample_rate: int,
+	pre_filters: str,
+	loudnorm_opts: str,
+	cache_path: Optional[Path] = None,
+) -> Optional[dict]:
+	"""
+	Run loudnorm's analysis pass over the pre-loudnorm chain and return the
+	measured stats, or None when they are unusable (e.g. -inf on a silent mix).
+	Usable results are cached by a hash of the PCM and filter chain.
+	"""
+	key = hashlib.sha256(pcm)
+	key.update(f"{sample_rate}:{pre_filters}:{loudnorm_opts}".encode())
+	digest = key.hexdigest()
+
+	cache = {}
+	if cache_path is not None and cache_path.exists():
+		try:
+			cache = json.loads(cache_path.read_text())
+		except (OSError, ValueError):
+			cache = {}
+	if digest in cache:
+		return cache[digest]
 
-def apply_mastering_ffmpeg(input_wav: Path, output_wav: Path, target_lufs: float) -> None:
+	try:
+		_, stderr = (
+			ffmpeg
+			.input("pipe:", format="f32le", ac=2, ar=str(sample_rate))
+			.output("-", format="null", af=f"{pre_filters},{loudnorm_opts}:print_format=json")
+			.run(input=pcm, capture_stdout=True, capture_stderr=True)
+		)
+	except ffmpeg.Error as exc:
+		stderr = exc.stderr.decode(errors="ignore") if exc.stderr else "No stderr captured."
+		raise RuntimeError(f"FFmpeg loudness analysis failed:\n{stderr}") from exc
+
+	text = stderr.decode(errors="ignore")
+	start, end = text.rfind("{"), text.rfind("}")
+	if start == -1 or end < start:
+		raise RuntimeError(f"Could not parse loudnorm measurements:\n{text}")
+	stats = json.loads(text[start:end + 1])
+
+	def finite(value) -> bool:
+		try:
+			return math.isfinite(float(value))
+		except (TypeError, ValueError):
+			return False
+
+	if not all(finite(stats.get(k)) for k in LOUDNORM_MEASURED_KEYS):
+		return None
+
+	if cache_path is not None:
+		cache[digest] = stats
+		# Write to a temp file and rename so an interrupted run can't corrupt the cache
+		tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+		tmp_path.write_text(json.dumps(cache, indent=2))
+		os.replace(tmp_path, cache_path)
+	return stats
+
+
+def apply_mastering_ffmpeg(
+	pcm: memoryview,
+	output_wav: Path,
+	target_lufs: float,
+	sample_rate: int,
+	cache_path: Optional[Path] = None,
+) -> None:
 	"""
-	Apply a simple mastering chain with ffmpeg filters:
+	Apply a simple mastering chain to interleaved stereo f32le PCM, piped to
+	ffmpeg's stdin so the mix never round-trips through disk:
 	- highpass at 20 Hz
 	- compression
-	- loudness normalization to target LUFS
+	- loudness normalization to target LUFS (two-pass, linear mode)
 	- limiter to -1 dBTP
+	The mix stays float (keeping headroom) until ffmpeg encodes 16-bit output.
 	"""
 	limit_dbtp = -1.0  # desired true peak limit in dBTP
 	limit_linear = db_to_ratio(limit_dbtp)
+	pre_filters = (
+		"highpass=f=20,"
+		"acompressor=threshold=-18dB:ratio=3:attack=5:release=50:makeup=5"
+	)
+	loudnorm_opts = f"loudnorm=I={target_lufs}:TP={limit_dbtp}:LRA=11"
+	stats = _measure_loudnorm(pcm, sample_rate, pre_filters, loudnorm_opts, cache_path)
+	if stats is not None:
+		loudnorm = (
+			f"{loudnorm_opts}:"
+			f"measured_I={stats['input_i']}:measured_LRA={stats['input_lra']}:"
+			f"measured_TP={stats['input_tp']}:measured_thresh={stats['input_thresh']}:"
+			f"offset={stats['target_offset']}:linear=true"
+		)
+	else:
+		# Silent/near-silent mixes measure as -inf; use one-pass dynamic mode
+		loudnorm = loudnorm_opts
 	filter_chain = (
-		f"highpass=f=20,"
-		f"acompressor=threshold=-18dB:ratio=3:attack=5:release=50:makeup=5,"
-		f"loudnorm=I={target_lufs}:TP={limit_dbtp}:LRA=11,"
+		f"{pre_filters},"
+		f"{loudnorm},"
 		f"alimiter=limit={limit_linear:.6f}"
 	)
 	try:
 		(
 			ffmpeg
-			.input(str(input_wav))
+			.input("pipe:", format="f32le", ac=2, ar=str(sample_rate))
 			.output(str(output_wav), acodec="pcm_s16le", af=filter_chain, ac=2, ar="44100")
 			.overwrite_output()
-			.run(quiet=True, capture_stdout=True, capture_stderr=True)
+			.run(input=pcm, quiet=True, capture_stdout=True, capture_stderr=True)
 		)
 	except ffmpeg.Error as exc:
 		stderr = exc.stderr.decode(errors="ignore") if exc.stderr else "No stderr captured."
@@ -206,6 +384,7 @@ def apply_mastering_ffmpeg(input_wav: Path, output_wav: Path, target_lufs: float
 @click.option("--other-gain-db", type=float, default=0.0, show_default=True)
 @click.option("--master-target-lufs", type=float, default=-10.0, show_default=True, help="Target integrated LUFS.")
 @click.option("--sample-rate", type=int, default=44100, show_default=True, help="Output sample rate.")
+@click.option("--keep-premaster", is_flag=True, default=False, help="Also write the unmastered mix to <output-dir>/final.")
 def main(
 	input_path: Path,
 	output_dir: Path,
@@ -217,6 +396,7 @@ def main(
 	other_gain_db: float,
 	master_target_lufs: float,
 	sample_rate: int,
+	keep_premaster: bool,
 ):
 	rprint("[bold]SoundCloud Track Processor[/bold] — local stems + modernize")
 	if not check_ffmpeg_available():
@@ -243,38 +423,42 @@ def main(
 			"bass": get("bass"),
 			"other": get("other"),
 		}
-		def optional_seg(p: Path) -> Optional[AudioSegment]:
-			return load_audio_segment(p, sample_rate) if p.exists() else None
-
-		vocals_seg = optional_seg(stem_paths["vocals"])
-		drums_seg = optional_seg(stem_paths["drums"])
-		bass_seg = optional_seg(stem_paths["bass"])
-		other_seg = optional_seg(stem_paths["other"])
-
-		replace_vocals_seg = load_audio_segment(replace_vocals, sample_rate) if replace_vocals else None
-		replace_instrumental_seg = load_audio_segment(replace_instrumental, sample_rate) if replace_instrumental else None
+		sources = {name: p for name, p in stem_paths.items() if p.exists()}
+		if replace_vocals:
+			sources["replace_vocals"] = replace_vocals
+		if replace_instrumental:
+			sources["replace_instrumental"] = replace_instrumental
+		audio = load_audio_batch(sources, sample_rate, resolve_resample_device())
 
 		rprint("[cyan]Mixing stems...[/cyan]")
 		mix = mix_stems(
-			vocals=vocals_seg,
-			drums=drums_seg,
-			bass=bass_seg,
-			other=other_seg,
-			replace_vocals=replace_vocals_seg,
-			replace_instrumental=replace_instrumental_seg,
+			vocals=audio.get("vocals"),
+			drums=audio.get("drums"),
+			bass=audio.get("bass"),
+			other=audio.get("other"),
+			replace_vocals=audio.get("replace_vocals"),
+			replace_instrumental=audio.get("replace_instrumental"),
 			gains_db=(vocals_gain_db, drums_gain_db, bass_gain_db, other_gain_db),
 		)
 
-		# Export pre-master
-		pre_master_wav = final_root / f"{input_path.stem}_premaster.wav"
-		mix = mix.set_frame_rate(sample_rate).set_channels(2).set_sample_width(2)
-		mix.export(str(pre_master_wav), format="wav")
-		rprint(f"[green]Wrote premaster:[/green] {pre_master_wav}")
+		# mix.T is contiguous (N, 2) f32le frames; expose its bytes without copying
+		pcm = memoryview(np.ascontiguousarray(mix.T)).cast("B")
+
+		if keep_premaster:
+			pre_master_wav = final_root / f"{input_path.stem}_premaster.wav"
+			sf.write(str(pre_master_wav), mix.T, sample_rate, subtype="FLOAT")
+			rprint(f"[green]Wrote premaster:[/green] {pre_master_wav}")
 
 		# Master
 		mastered_wav = final_root / f"{input_path.stem}_final_master.wav"
 		rprint("[cyan]Applying mastering chain...[/cyan]")
-		apply_mastering_ffmpeg(pre_master_wav, mastered_wav, master_target_lufs)
+		apply_mastering_ffmpeg(
+			pcm,
+			mastered_wav,
+			master_target_lufs,
+			sample_rate,
+			cache_path=final_root / ".loudnorm_cache.json",
+		)
 		rprint(f"[bold green]Done![/bold green] Final master: {mastered_wav}")
 
 